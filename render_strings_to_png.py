@@ -4,8 +4,22 @@ import io
 import os
 import sys
 import argparse
+import functools
+import re
 import json
+import shutil
+import hashlib
+import tempfile
 import subprocess
+import concurrent.futures
+
+# the number of renditions that are handed to a single ImageMagick/XeLaTeX call
+RENDITIONS_PER_BATCH = 8
+# the directory in which rendered PNGs are kept, so they can be reused for identical renditions (also in later runs)
+RENDER_CACHE_DIRECTORY = 'render_cache'
+# the free space (in bytes) that /dev/shm needs to have for ImageMagick to keep its temporary files there
+# (a single page rasterized at a high density can take up gigabytes)
+TMPFS_MIN_FREE_SPACE = 4 * 1024 ** 3
 
 def EscapeFileName(unsafeFileName):
 	safeFileName = ''.join(c if c.isalnum() or c in ('_', '-') else '_' for c in unsafeFileName).strip()
@@ -14,19 +28,95 @@ def EscapeFileName(unsafeFileName):
 	else:
 		raise Exception('Filename \'{0}\' not valid.'.format(unsafeFileName))
 
+def GetRenderCachePath(engine, *renderParameters):
+	'Returns the path under which a PNG rendered with the given engine and parameters is cached.'
+	key = hashlib.sha1('|'.join([engine] + [str(p) for p in renderParameters]).encode('utf-8')).hexdigest()
+	return os.path.join(RENDER_CACHE_DIRECTORY, '{0}.png'.format(key))
+
+def UseRenderCache(strCachePath, strOutputPath, dictQueuedRenders, listCachedCopies):
+	'Copies a cached PNG to the output path, or if it is already queued for rendering, remembers to copy it afterwards. Otherwise the output path is queued for rendering. Returns whether the PNG still needs to be rendered.'
+	if os.path.isfile(strCachePath):
+		shutil.copyfile(strCachePath, strOutputPath)
+		return False
+	if strCachePath in dictQueuedRenders:
+		listCachedCopies.append((strCachePath, strOutputPath))
+		return False
+	dictQueuedRenders[strCachePath] = strOutputPath
+	return True
+
+def UpdateRenderCache(dictQueuedRenders, listCachedCopies):
+	'Stores the PNGs that were rendered in the cache and copies them to the outputs that were waiting for them.'
+	os.makedirs(RENDER_CACHE_DIRECTORY, exist_ok=True)
+	for strCachePath, strOutputPath in dictQueuedRenders.items():
+		if os.path.isfile(strOutputPath):
+			# copy to a temporary file first, so that an interrupted copy never ends up in the cache
+			fd, strTempPath = tempfile.mkstemp(suffix='.tmp', dir=RENDER_CACHE_DIRECTORY)
+			os.close(fd)
+			try:
+				shutil.copyfile(strOutputPath, strTempPath)
+				os.replace(strTempPath, strCachePath)
+			finally:
+				if os.path.isfile(strTempPath):
+					os.remove(strTempPath)
+	for strCachePath, strOutputPath in listCachedCopies:
+		if os.path.isfile(strCachePath):
+			shutil.copyfile(strCachePath, strOutputPath)
+
+# translation table for unsafe characters in a Pango string
+_PANGO_TRANS = str.maketrans({
+	'&': r'&amp\;',
+	'<': r'&lt\;',
+	'>': r'&gt\;',
+	'"': r'&quot\;',
+	'\'': r'&apos\;',
+	'\\': r'&#x5c\;',
+	'%': r'&#x25\;'})
+
 def EscapePango(unsafePangoString):
-	return unsafePangoString.translate(str.maketrans({
-		'&': r'&amp\;',
-		'<': r'&lt\;',
-		'>': r'&gt\;',
-		'"': r'&quot\;',
-		'\'': r'&apos\;',
-		'\\': r'&#x5c\;',
-		'%': r'&#x25\;'}))
-
-def GeneratePngsWithPango(listCharSegments, strOutputDirectory, settings):
-	'Takes a list with character segment objects and makes PNGs of them in the specified directory. Returns the total number of PNGs created.'
-	counterPng = 0
+	return unsafePangoString.translate(_PANGO_TRANS)
+
+def GetPangoImageArguments(pangoString, flip, flop, density, supersampling):
+	'Returns the ImageMagick arguments for rendering a Pango string to an image at the given density (in DPI), supersampled by the given factor.'
+	# Pango doesn't antialias, so (unless the supersampling factor is 1) first generate a too large image and then downsize it
+	imageArguments = ['-density', str(density * supersampling), pangoString, '-transparent', 'white']
+	if 1 < supersampling:
+		imageArguments += ['-filter', 'Lanczos', '-resize', '{0:g}%'.format(100 / supersampling)]
+	imageArguments.append('-trim')
+	if flip:
+		imageArguments.append('-flip')
+	if flop:
+		imageArguments.append('-flop')
+	return imageArguments
+
+def RenderPngWithPango(task):
+	'Takes a tuple (output path, Pango string, flip, flop, density, supersampling factor) and renders it to a PNG with ImageMagick. Returns the output path.'
+	strOutputPath, *renderParameters = task
+	# generate a PNG using ImageMagick with Pango
+	subprocess.run(['magick', '-background', 'white', '-antialias'] + GetPangoImageArguments(*renderParameters) + [strOutputPath])
+	return strOutputPath
+
+def RenderPngsWithPango(tasks):
+	'Takes a list of tuples (output path, Pango string, flip, flop, density, supersampling factor) and renders them to PNGs with a single ImageMagick call, falling back to one call per PNG if that fails. Returns the number of PNGs created.'
+	# every rendition gets its own image sequence in parentheses, which is written out right away
+	subprocessArguments = ['magick', '-background', 'white', '-antialias']
+	for strOutputPath, *renderParameters in tasks:
+		subprocessArguments += ['('] + GetPangoImageArguments(*renderParameters) + ['-write', strOutputPath, ')']
+	subprocessArguments.append('null:')
+	if subprocess.run(subprocessArguments).returncode != 0:
+		for task in tasks:
+			RenderPngWithPango(task)
+	return len(tasks)
+
+def GeneratePngsWithPango(listCharSegments, strOutputDirectory, settings, executor):
+	'Takes a list with character segment objects and makes PNGs of them in the specified directory, rendering them in parallel on the given executor. Returns the total number of PNGs created.'
+	# the resolution of the PNGs and the factor by which they are supersampled (for antialiasing)
+	density = settings.get('pangoDensity') or 150
+	supersampling = settings.get('pangoSupersampling') or 4
+	tasks = []
+	# PNGs that are cached or rendered in this run already are copied instead
+	dictQueuedRenders = {}
+	listCachedCopies = []
+	counterCached = 0
 	counterSeg = 0
 	# go through all the character segment objects in the list that we got
 	for charSegment in listCharSegments:
@@ -40,35 +130,144 @@ def GeneratePngsWithPango(listCharSegments, strOutputDirectory, settings):
 			fileName = '{0:03d}-{1}-{2}.png'.format(counterSeg + 1, EscapeFileName(name), i + 1) if 0 < i else '{0:03d}-{1}.png'.format(counterSeg + 1, EscapeFileName(name))
 			font = listRenditions[i].get('font') or settings.get('defaultFont')
 			renderString = listRenditions[i].get('pango') or EscapePango(listRenditions[i].get('utf8'))
-			# generate a PNG using ImageMagick with Pango
-			# (unfortunately it doesn't antialias so we first generate a too large image and then downsize it)
-			subprocessArguments = ['magick', '-background', 'white', '-density', '600', settings['pango'].format(renderString, font), '-transparent', 'white', '-antialias', '-resize', '25%', '-trim', os.path.join(strOutputDirectory, fileName)]
-			if listRenditions[i].get('pango-flip'):
-				subprocessArguments.insert(-1, '-flip')
-			if listRenditions[i].get('pango-flop'):
-				subprocessArguments.insert(-1, '-flop')
-			subprocess.run(subprocessArguments)
-			counterPng += 1
+			task = (os.path.join(strOutputDirectory, fileName), settings['pango'].format(renderString, font), bool(listRenditions[i].get('pango-flip')), bool(listRenditions[i].get('pango-flop')), density, supersampling)
+			if UseRenderCache(GetRenderCachePath('pango', *task[1:]), task[0], dictQueuedRenders, listCachedCopies):
+				tasks.append(task)
+			else:
+				counterCached += 1
 		counterSeg += 1
-	return counterPng
+	# render all the PNGs in batches (each rendition is independent of the others)
+	batches = [tasks[i:i + RENDITIONS_PER_BATCH] for i in range(0, len(tasks), RENDITIONS_PER_BATCH)]
+	counterRendered = sum(executor.map(RenderPngsWithPango, batches))
+	UpdateRenderCache(dictQueuedRenders, listCachedCopies)
+	return counterRendered + counterCached
+
+# translation table for unsafe characters in a XeLaTeX string
+_XELATEX_TRANS = str.maketrans({
+	'#': r'\#',
+	'&': r'\&',
+	'%': r'\%',
+	'$': r'\$',
+	'_': r'\_',
+	'{': r'\{',
+	'}': r'\}',
+	'~': r'\textasciitilde{}',
+	'^': r'\textasciicircum{}',
+	'\\': r'\textbackslash{}',
+	'"': r'\char"22'})
 
 def EscapeXelatex(unsafeXelatexString):
-	return unsafeXelatexString.translate(str.maketrans({
-		'#': r'\#',
-		'&': r'\&',
-		'%': r'\%',
-		'$': r'\$',
-		'_': r'\_',
-		'{': r'\{',
-		'}': r'\}',
-		'~': r'\textasciitilde{}',
-		'^': r'\textasciicircum{}',
-		'\\': r'\textbackslash{}',
-		'"': r'\char"22'}))
-
-def GeneratePngsWithXelatex(listCharSegments, strOutputDirectory, strWorkingDirectory, settings):
-	'Takes a list with character segment objects and makes PNGs of them in the specified directory. Returns the total number of PNGs created.'
-	counterPng = 0
+	return unsafeXelatexString.translate(_XELATEX_TRANS)
+
+# the name of the XeLaTeX format file with the precompiled preamble
+XELATEX_FORMAT_NAME = 'memrise_preamble'
+
+def SplitXelatexPreamble(xelatexTemplate):
+	'Takes a XeLaTeX template and returns the leading part of its preamble that is the same for all renditions (i.e. everything before the line with the font or the start of the document), or an empty string if there is no such part.'
+	end = xelatexTemplate.find('\\begin{{document}}')
+	if end < 0:
+		return ''
+	fontIndex = xelatexTemplate.find('{1}', 0, end)
+	if 0 <= fontIndex:
+		end = xelatexTemplate.rfind('\n', 0, fontIndex) + 1
+	try:
+		return xelatexTemplate[:end].format()
+	except (IndexError, KeyError, ValueError):
+		return ''
+
+def MakeXelatexFormat(strFixedPreamble, strWorkingDirectory):
+	'Dumps the given preamble to a XeLaTeX format file in the working directory using the mylatexformat package (unless that was done before). Returns whether the format file is available.'
+	formatPath = os.path.join(strWorkingDirectory, '{0}.fmt'.format(XELATEX_FORMAT_NAME))
+	if not os.path.isfile(formatPath):
+		with open(os.path.join(strWorkingDirectory, '{0}.tex'.format(XELATEX_FORMAT_NAME)), 'w', encoding='utf8') as f:
+			f.write(strFixedPreamble + '\\begin{document}\n\\end{document}\n')
+		subprocess.run(['xelatex', '-ini', '-interaction=nonstopmode', '-jobname={0}'.format(XELATEX_FORMAT_NAME), '&xelatex', 'mylatexformat.ltx', '{0}.tex'.format(XELATEX_FORMAT_NAME)], cwd=strWorkingDirectory, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	return os.path.isfile(formatPath)
+
+def SplitXelatexDocument(xelatexDocument):
+	'Takes a XeLaTeX document and splits it into its head (up to and including the start of the document environment), body and tail (from the end of the document environment on). Returns None if the document has no such structure.'
+	begin = xelatexDocument.find('\\begin{document}')
+	end = xelatexDocument.rfind('\\end{document}')
+	if begin < 0 or end < begin:
+		return None
+	begin += len('\\begin{document}')
+	return xelatexDocument[:begin], xelatexDocument[begin:end], xelatexDocument[end:]
+
+def CountXelatexPages(strWorkingDirectory, jobName):
+	'Returns the number of pages that XeLaTeX reports to have written in the log file of the given job.'
+	with open(os.path.join(strWorkingDirectory, '{0}.log'.format(jobName)), encoding='utf8', errors='replace') as f:
+		match = re.search(r'Output written on .*?\((\d+)\s+pages?', f.read(), re.DOTALL)
+	return int(match.group(1)) if match else 0
+
+def CompileXelatex(xelatexDocument, strWorkingDirectory, jobName, lenFixedPreamble=0):
+	'Writes a XeLaTeX document to a file in the working directory and compiles it to a PDF, using the precompiled preamble if its length is given (and compiling the document as is if that fails). Returns the path of the PDF and its number of pages, or (None, 0) if no PDF was produced.'
+	pdfPath = os.path.join(strWorkingDirectory, '{0}.pdf'.format(jobName))
+	attempts = [(xelatexDocument, [])]
+	if 0 < lenFixedPreamble:
+		# with a precompiled preamble, the document only needs to mark where that preamble ends
+		attempts.insert(0, (xelatexDocument[:lenFixedPreamble] + '\\endofdump\n' + xelatexDocument[lenFixedPreamble:], ['-fmt={0}'.format(XELATEX_FORMAT_NAME)]))
+	for strDocument, formatArguments in attempts:
+		if os.path.isfile(pdfPath):
+			os.remove(pdfPath)
+		with open(os.path.join(strWorkingDirectory, '{0}.tex'.format(jobName)), 'w', encoding='utf8') as f:
+			f.write(strDocument)
+		subprocess.run(['xelatex', '-interaction=batchmode', '-halt-on-error'] + formatArguments + ['{0}.tex'.format(jobName)], cwd=strWorkingDirectory, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		if os.path.isfile(pdfPath):
+			return pdfPath, CountXelatexPages(strWorkingDirectory, jobName)
+	return None, 0
+
+def CompilePdfsWithXelatex(task):
+	'Takes a tuple (list of output paths, XeLaTeX document head, list of XeLaTeX document bodies, XeLaTeX document tail, working directory, job name, length of the precompiled preamble) and compiles the bodies with XeLaTeX as the pages of a single document. Returns a list of tuples (PDF path, list of output paths for its pages) for rasterizing.'
+	listOutputPaths, head, listBodies, tail, strWorkingDirectory, jobName, lenFixedPreamble = task
+	# generate a PDF with a page per body in the working directory with XeLaTeX
+	# (every task has its own job name, so that parallel runs don't overwrite each other's files,
+	# and every body is put in a group of its own, so that its declarations don't carry over to the next pages;
+	# the group only closes after the body's paragraph has ended, so that it is set with the body's own baselineskip)
+	pdfPath, pageCount = CompileXelatex(head + '\n\\newpage\n'.join('\\begingroup{0}\\par\\endgroup'.format(body) for body in listBodies) + tail, strWorkingDirectory, jobName, lenFixedPreamble)
+	if pdfPath is not None and (pageCount == len(listOutputPaths) or len(listOutputPaths) == 1):
+		return [(pdfPath, listOutputPaths)]
+	elif 1 < len(listOutputPaths):
+		# the bodies didn't end up on pages of their own (e.g. because of the document class), so compile them one by one
+		# (each to a PDF of its own, as they are rasterized later on)
+		return [pdf for k, (strOutputPath, body) in enumerate(zip(listOutputPaths, listBodies)) for pdf in CompilePdfsWithXelatex(([strOutputPath], head, [body], tail, strWorkingDirectory, '{0}-{1}'.format(jobName, k), lenFixedPreamble))]
+	return []
+
+def RasterizePdfWithImageMagick(task):
+	'Takes a tuple (PDF path, list of output paths for its pages, density) and renders the pages of the PDF to PNGs with ImageMagick at the given density (in DPI). Returns the number of PNGs created.'
+	pdfPath, listOutputPaths, density = task
+	if len(listOutputPaths) == 1:
+		# render the PDF to a PNG in the output directory using ImageMagick (which reads the PDF from STDIN)
+		with open(pdfPath, 'rb') as pdf:
+			subprocess.run(['magick', '-antialias', '-density', str(density), 'pdf:-', '-trim', listOutputPaths[0]], stdin=pdf)
+	else:
+		# render the pages of the PDF one by one (a whole page at a high density takes up a lot of memory until it is trimmed,
+		# so ImageMagick should only hold a single one at a time)
+		for page, strOutputPath in enumerate(listOutputPaths):
+			subprocess.run(['magick', '-antialias', '-density', str(density), 'pdf:{0}[{1}]'.format(pdfPath, page), '-trim', strOutputPath])
+	return len(listOutputPaths)
+
+def RenderPngsWithXelatex(task):
+	'Takes a tuple (list of output paths, XeLaTeX document head, list of XeLaTeX document bodies, XeLaTeX document tail, working directory, job name, length of the precompiled preamble, density) and compiles the bodies with XeLaTeX, then rasterizes the resulting PDFs with ImageMagick at the given density (in DPI). Returns the number of PNGs created.'
+	*compileTask, density = task
+	counterRendered = 0
+	for pdf in CompilePdfsWithXelatex(tuple(compileTask)):
+		counterRendered += RasterizePdfWithImageMagick(pdf + (density,))
+	return counterRendered
+
+def GeneratePngsWithXelatex(listCharSegments, strOutputDirectory, strWorkingDirectory, settings, executor):
+	'Takes a list with character segment objects and makes PNGs of them in the specified directory, rendering them in parallel on the given executor. Returns the total number of PNGs created.'
+	# precompile the part of the preamble that is the same for all renditions
+	fixedPreamble = SplitXelatexPreamble(settings['xelatex'])
+	lenFixedPreamble = len(fixedPreamble) if fixedPreamble and MakeXelatexFormat(fixedPreamble, strWorkingDirectory) else 0
+	# the resolution at which the PDFs are rasterized (the PNGs' size scales along with it)
+	density = settings.get('xelatexDensity') or 1200
+	# renditions with the same document head and tail (i.e. the same font) can be compiled as pages of a single document
+	batches = []
+	groups = {}
+	# PNGs that are cached or rendered in this run already are copied instead
+	dictQueuedRenders = {}
+	listCachedCopies = []
+	counterCached = 0
 	counterSeg = 0
 	# go through all the character segment objects in the list that we got
 	for charSegment in listCharSegments:
@@ -78,19 +277,31 @@ def GeneratePngsWithXelatex(listCharSegments, strOutputDirectory, strWorkingDire
 		listRenditions = charSegment.get('renditions')
 		print('\t{0}'.format(name))
 		for i in range(0, len(listRenditions)):
-			# set up the parameters necessary for calling XeLaTeX
+			# set up the parameters necessary for calling XeLaTeX and ImageMagick
+			fileName = '{0:03d}-{1}-{2}.png'.format(counterSeg + 1, EscapeFileName(name), i + 1) if 0 < i else '{0:03d}-{1}.png'.format(counterSeg + 1, EscapeFileName(name))
 			font = listRenditions[i].get('font') or settings.get('defaultFont')
 			renderString = listRenditions[i].get('xelatex') or EscapeXelatex(listRenditions[i].get('utf8'))
-			# generate a PDF in the working directory with XeLaTeX
-			with subprocess.Popen(['xelatex', '-output-directory={0}'.format(strWorkingDirectory)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=False) as xelatex:
-				xelatex.communicate(input=(settings['xelatex'].format(renderString, font)).encode('utf-8'))
-			# set up the parameters necessary for calling ImageMagick
-			fileName = '{0:03d}-{1}-{2}.png'.format(counterSeg + 1, EscapeFileName(name), i + 1) if 0 < i else '{0:03d}-{1}.png'.format(counterSeg + 1, EscapeFileName(name))
-			# render the PDF to a PNG in the output directory using ImageMagick
-			subprocess.run(['magick', '-antialias', '-density', '1200', os.path.join(strWorkingDirectory, 'texput.pdf'), '-trim', os.path.join(strOutputDirectory, fileName)])
-			counterPng += 1
+			xelatexDocument = settings['xelatex'].format(renderString, font)
+			if not UseRenderCache(GetRenderCachePath('xelatex', xelatexDocument, density), os.path.join(strOutputDirectory, fileName), dictQueuedRenders, listCachedCopies):
+				counterCached += 1
+				continue
+			documentParts = SplitXelatexDocument(xelatexDocument)
+			if documentParts is None:
+				batches.append(([os.path.join(strOutputDirectory, fileName)], xelatexDocument, [''], ''))
+			else:
+				head, body, tail = documentParts
+				groups.setdefault((head, tail), []).append((os.path.join(strOutputDirectory, fileName), body))
 		counterSeg += 1
-	return counterPng
+	for (head, tail), listRenditionBodies in groups.items():
+		for i in range(0, len(listRenditionBodies), RENDITIONS_PER_BATCH):
+			batch = listRenditionBodies[i:i + RENDITIONS_PER_BATCH]
+			batches.append(([strOutputPath for strOutputPath, _ in batch], head, [body for _, body in batch], tail))
+	# render all the batches of PNGs (each batch is independent of the others)
+	# (every worker compiles a batch and then rasterizes it, so XeLaTeX and ImageMagick only run side by side in different workers of the pool)
+	tasks = [(listOutputPaths, head, listBodies, tail, strWorkingDirectory, 'texput{0}'.format(j), lenFixedPreamble, density) for j, (listOutputPaths, head, listBodies, tail) in enumerate(batches)]
+	counterRendered = sum(executor.map(RenderPngsWithXelatex, tasks))
+	UpdateRenderCache(dictQueuedRenders, listCachedCopies)
+	return counterRendered + counterCached
 
 def main():
 	# setup STDOUT to accept UTF-8
@@ -105,41 +316,61 @@ def main():
 		os.chdir(os.path.dirname(os.path.abspath(args.JsonSpecificationFile.name)))
 	# open the JSON data and parse it
 	with args.JsonSpecificationFile as f:
-		jsonCharacterData = json.loads(f.read())
+		jsonCharacterData = json.load(f)
 	settings = jsonCharacterData['settings']
 	# set up an output directory and if necessary also a working directory
 	dirOutput = '{0}-{1}-png'.format(EscapeFileName(settings.get('name')), args.engine) if settings.get('name') is not None else '{0}-png'.format(args.engine)
-	dirCounter = -1
-	while os.path.exists(dirOutput + str(dirCounter)):
-		dirCounter -= 1
+	# (numbered one below the lowest number of any previous output directory)
+	dirPattern = re.compile(re.escape(dirOutput) + r'(-\d+)$')
+	dirCounter = min((int(match.group(1)) for match in (dirPattern.match(entry.name) for entry in os.scandir('.')) if match), default=0) - 1
 	dirOutput += str(dirCounter)
 	os.makedirs(dirOutput)
 	del(dirCounter)
+	dirWorking = None
 	if args.engine == 'xelatex':
 		dirWorking = os.path.join(dirOutput, 'tmp')
 		os.makedirs(dirWorking)
 	print('Output directory is \'{0}\'.'.format(os.path.abspath(dirOutput)))
-	# generate PNGs
-	counterTotalPng = 0
-	characterSubsets = jsonCharacterData.get('subsets')
-	if characterSubsets is not None:
-		for subsetName, subsetListOfCharSegments in characterSubsets.items():
-			# make a subdirectory
-			subdir = os.path.join(dirOutput, EscapeFileName(subsetName))
-			os.makedirs(subdir)
-			# fetch the subset of character segments
-			print('Processing {0} items in subset \'{1}\'...'.format(len(subsetListOfCharSegments), subsetName))
-			# create the PNGs
-			pngsCreated = {
-				'pango':   lambda x: GeneratePngsWithPango(subsetListOfCharSegments, subdir, settings),
-				'xelatex': lambda x: GeneratePngsWithXelatex(subsetListOfCharSegments, subdir, dirWorking, settings)
-			}[args.engine](None)
-			print('{0} PNGs created in \'{1}\''.format(pngsCreated, subdir))
-			counterTotalPng += pngsCreated
-	# remove working dir (if any) after removing all files in it
-	if 'dirWorking' in locals():
-		[os.remove(os.path.join(dirWorking, f)) for f in os.listdir(dirWorking)]
-		os.rmdir(dirWorking)
+	# let ImageMagick keep its temporary files (e.g. of rasterized PDFs) in memory, if the system offers that and has enough room,
+	# or else in the output directory (this is set before the rendering processes are started, so they inherit it)
+	dirMagickTemp = None
+	if 'MAGICK_TMPDIR' not in os.environ:
+		if os.path.isdir('/dev/shm') and TMPFS_MIN_FREE_SPACE <= shutil.disk_usage('/dev/shm').free:
+			dirMagickTemp = tempfile.mkdtemp(prefix='magick-', dir='/dev/shm')
+		else:
+			dirMagickTemp = os.path.join(dirOutput, 'magick_tmp')
+			os.makedirs(dirMagickTemp)
+		os.environ['MAGICK_TMPDIR'] = dirMagickTemp
+	# pick the function that generates the PNGs with the chosen engine
+	if args.engine == 'xelatex':
+		GeneratePngs = functools.partial(GeneratePngsWithXelatex, strWorkingDirectory=dirWorking)
+	else:
+		GeneratePngs = GeneratePngsWithPango
+	try:
+		# generate PNGs
+		counterTotalPng = 0
+		characterSubsets = jsonCharacterData.get('subsets')
+		if characterSubsets is not None:
+			# use one process per CPU core for rendering
+			with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+				for subsetName, subsetListOfCharSegments in characterSubsets.items():
+					# make a subdirectory
+					subdir = os.path.join(dirOutput, EscapeFileName(subsetName))
+					os.makedirs(subdir)
+					# fetch the subset of character segments
+					print('Processing {0} items in subset \'{1}\'...'.format(len(subsetListOfCharSegments), subsetName))
+					# create the PNGs
+					pngsCreated = GeneratePngs(subsetListOfCharSegments, subdir, settings=settings, executor=executor)
+					print('{0} PNGs created in \'{1}\''.format(pngsCreated, subdir))
+					counterTotalPng += pngsCreated
+	finally:
+		# remove working dir (if any) along with all files in it
+		if dirWorking is not None:
+			shutil.rmtree(dirWorking, ignore_errors=True)
+		# remove ImageMagick's temporary directory (if any), also when interrupted
+		if dirMagickTemp is not None:
+			shutil.rmtree(dirMagickTemp, ignore_errors=True)
+			del os.environ['MAGICK_TMPDIR']
 	# done
 	print('Done! {0} total PNGs written to {1}!'.format(counterTotalPng, dirOutput))
 
@@ -4,17 +4,71 @@ levels (using either Pango or XeLaTeX), and add those rendered images to the
 words in a (pre-existing) image column.
 """
 
+import io
 import os
 import time
+import shutil
+import tempfile
+import concurrent.futures
 # interaction with browser
 from selenium import webdriver
-# parsing HTML
-from bs4 import BeautifulSoup
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import (
+    StaleElementReferenceException, TimeoutException
+    )
 # running commands
 import subprocess
 # GUI elements
 import tkinter as tk
 from tkinter import ttk as ttk, font as tkf
+# rendering text in-process (optional, through PyGObject and pycairo)
+try:
+    import cairo
+    import gi
+    gi.require_version('Pango', '1.0')
+    gi.require_version('PangoCairo', '1.0')
+    from gi.repository import GLib, PangoCairo
+except (ImportError, ValueError):
+    cairo = None
+
+# translation table for unsafe characters in a XeLaTeX string
+_XELATEX_TRANS = str.maketrans({
+    '#': r'\#',
+    '&': r'\&',
+    '%': r'\%',
+    '$': r'\$',
+    '_': r'\_',
+    '{': r'\{',
+    '}': r'\}',
+    '~': r'\textasciitilde{}',
+    '^': r'\textasciicircum{}',
+    '\\': r'\textbackslash{}',
+    '"': r'\char"22'
+    })
+
+# translation table for unsafe characters in a Pango string
+_PANGO_TRANS = str.maketrans({
+    '&': r'&amp\;',
+    '<': r'&lt\;',
+    '>': r'&gt\;',
+    '"': r'&quot\;',
+    '\'': r'&apos\;',
+    '\\': r'&#x5c\;',
+    '%': r'&#x25\;'
+    })
+
+# directory for temporary files (in memory, if the system offers that)
+_TMPFS_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# the free space (in bytes) that the in-memory directory needs to have for
+# ImageMagick to keep its temporary files there
+_TMPFS_MIN_FREE_SPACE = 4 * 1024 ** 3
+
+# directory for the image files that the browser uploads (the working
+# directory, unless the MEMRISE_UPLOAD_DIR environment variable names another
+# one, e.g. /dev/shm, which sandboxed browsers such as snap packages can't read)
+_UPLOAD_DIR = os.path.abspath(os.environ.get('MEMRISE_UPLOAD_DIR') or os.getcwd())
 
 def debug(s, indent=0):
     """Debugging log function."""
@@ -27,8 +81,10 @@ class PngTextRenderer:
         """Constructor."""
         raise NotImplementedError('Abstract class PngTextRenderer')
     #
-    def render_text(self, filename, text, font='Arial'):
-        """Render the text with the given font to the given image filename."""
+    def render_text(self, filename, text, font='Arial', return_bytes=False):
+        """Render the text with the given font to the given image filename,
+        or if return_bytes is set, return the PNG image data instead.
+        """
         raise NotImplementedError('Abstract class PngTextRenderer')
 
 class XelatexImageMagickPngTextRenderer(PngTextRenderer):
@@ -73,59 +129,65 @@ class XelatexImageMagickPngTextRenderer(PngTextRenderer):
                 {0}
                 \end{{document}}
                 '''[1:].replace('                ', '')
-        # create a translation table for unsafe characters in a XeLaTeX string
-        self._trans = str.maketrans({
-            '#': r'\#',
-            '&': r'\&',
-            '%': r'\%',
-            '$': r'\$',
-            '_': r'\_',
-            '{': r'\{',
-            '}': r'\}',
-            '~': r'\textasciitilde{}',
-            '^': r'\textasciicircum{}',
-            '\\': r'\textbackslash{}',
-            '"': r'\char"22'
-            })
+        # split the template around the text, so the part after it is
+        # only formatted and encoded once (and the part before it once for
+        # each font, see _get_preamble_bytes)
+        self._preamble_format, postamble = self._xelatex_format.split('{0}')
+        self._postamble_bytes = postamble.format().encode('utf-8')
+        self._preamble_bytes = {}
+        # use the translation table for unsafe characters in a XeLaTeX string
+        self._trans = _XELATEX_TRANS
+    #
+    def _get_preamble_bytes(self, font):
+        """Get the encoded part of the XeLaTeX document before the text,
+        for the given font.
+        """
+        if font not in self._preamble_bytes:
+            self._preamble_bytes[font] = (
+                self._preamble_format.format(None, font).encode('utf-8')
+                )
+        return self._preamble_bytes[font]
     #
     def make_string_xelatex_safe(self, unsafe_string):
         """Escape unsafe characters in a text to go into a XeLaTeX string."""
         return unsafe_string.translate(self._trans)
     #
-    def render_text(self, filename, text, font='Arial'):
-        """Render the text with the given font to the given image filename."""
+    def render_text(self, filename, text, font='Arial', return_bytes=False):
+        """Render the text with the given font to the given image filename,
+        or if return_bytes is set, return the PNG image data instead.
+        """
         debug('<XeLaTeX.render_text>', indent=4)
         # set up the XeLaTeX document
-        xelatex_string = self._xelatex_format.format(
-            self.make_string_xelatex_safe(text),
-            font
+        xelatex_bytes = (
+            self._get_preamble_bytes(font)
+            + self.make_string_xelatex_safe(text).encode('utf-8')
+            + self._postamble_bytes
             )
-        # render the text (to a PDF file) using XeLaTeX
-        with subprocess.Popen(
-                ['xelatex', '-output-directory={0}'.format(os.getcwd())],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=False
-                ) as xelatex:
-            xelatex.communicate(input=xelatex_string.encode('utf-8'))
-        # convert the PDF to PNG using ImageMagick
-        filename_tex = 'texput.pdf'
-        filename_texlog = 'texput.log'
-        subprocess.run([
-            'magick', '-antialias', '-density', '1200',
-            filename_tex,
-            '-trim',
-            filename
-            ])
+        # render the text (to a PDF file in a temporary directory) using XeLaTeX
+        with tempfile.TemporaryDirectory() as dir_tex:
+            with subprocess.Popen(
+                    ['xelatex', '-output-directory={0}'.format(dir_tex)],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    universal_newlines=False
+                    ) as xelatex:
+                xelatex.communicate(input=xelatex_bytes)
+            # convert the PDF to PNG using ImageMagick, passing the PDF
+            # through its STDIN (and getting the PNG through its STDOUT)
+            with open(os.path.join(dir_tex, 'texput.pdf'), 'rb') as pdf:
+                magick = subprocess.run([
+                    'magick', '-antialias', '-density', '1200',
+                    'pdf:-',
+                    '-trim',
+                    'png:-' if return_bytes else filename
+                    ], input=pdf.read(), stdout=subprocess.PIPE)
+        if return_bytes:
+            debug('{} bytes produced'.format(len(magick.stdout)), indent=4)
+            return magick.stdout
         # check the existence of the PNG
         if os.path.isfile(filename):
             debug('file "{}" produced'.format(filename), indent=4)
-        # cleanup XeLaTeX files
-        for file in [filename_tex, filename_texlog]:
-            if os.path.isfile(file):
-                os.remove(file)
-                debug('temporary file "{}" removed'.format(file), indent=4)
 
 class ImageMagickPangoPngTextRenderer(PngTextRenderer):
     """Class to render text to an image using ImageMagick with Pango."""
@@ -138,23 +200,17 @@ class ImageMagickPangoPngTextRenderer(PngTextRenderer):
             '<span font_family="{1}" size="192000"> \n {0} \n </span>'
             '</markup>'
             )
-        # create a translation table for unsafe characters in a Pango string
-        self._trans = str.maketrans({
-            '&': r'&amp\;',
-            '<': r'&lt\;',
-            '>': r'&gt\;',
-            '"': r'&quot\;',
-            '\'': r'&apos\;',
-            '\\': r'&#x5c\;',
-            '%': r'&#x25\;'
-            })
+        # use the translation table for unsafe characters in a Pango string
+        self._trans = _PANGO_TRANS
     #
     def make_string_pango_safe(self, unsafe_string):
         """Escape unsafe characters in a text to go into a Pango string."""
         return unsafe_string.translate(self._trans)
     #
-    def render_text(self, filename, text, font='Arial'):
-        """Render the text with the given font to the given image filename."""
+    def render_text(self, filename, text, font='Arial', return_bytes=False):
+        """Render the text with the given font to the given image filename,
+        or if return_bytes is set, return the PNG image data instead.
+        """
         debug('<Pango.render_text>', indent=4)
         # set up the Pango string
         pango_string = self._pango_format.format(
@@ -162,17 +218,93 @@ class ImageMagickPangoPngTextRenderer(PngTextRenderer):
             font
             )
         # render the Pango string to PNG using ImageMagick
-        subprocess.run([
+        magick = subprocess.run([
             'magick', '-background', 'white', '-density', '600',
             pango_string,
             '-transparent', 'white', '-antialias', '-resize', '25%', '-trim',
-            filename
-            ])
+            'png:-' if return_bytes else filename
+            ], stdout=subprocess.PIPE)
+        if return_bytes:
+            return magick.stdout
+
+class CairoPangoPngTextRenderer(PngTextRenderer):
+    """Class to render text to an image with Pango and cairo, within this
+    process (instead of calling ImageMagick for each word).
+    """
+    #
+    def __init__(self, dpi=150):
+        """Constructor. The dpi is the resolution at which the text is
+        rendered (the same as ImageMagick's 4x downsized 600 DPI).
+        """
+        self._dpi = dpi
+        # set up the template for the Pango markup
+        self._pango_format = (
+            '<span font_family="{1}" size="192000">{0}</span>'
+            )
+    #
+    def _make_layout(self, context, markup):
+        """Make a Pango layout with the markup for the cairo context."""
+        layout = PangoCairo.create_layout(context)
+        PangoCairo.context_set_resolution(layout.get_context(), self._dpi)
+        layout.context_changed()
+        layout.set_markup(markup, -1)
+        return layout
+    #
+    def render_text(self, filename, text, font='Arial', return_bytes=False):
+        """Render the text with the given font to the given image filename,
+        or if return_bytes is set, return the PNG image data instead.
+        """
+        debug('<CairoPango.render_text>', indent=4)
+        # set up the Pango markup
+        markup = self._pango_format.format(
+            GLib.markup_escape_text(text, -1),
+            GLib.markup_escape_text(font, -1)
+            )
+        # lay out the text (on a dummy surface) to find the extents of the
+        # ink, i.e. the trimmed size of the image
+        layout = self._make_layout(
+            cairo.Context(cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1)),
+            markup
+            )
+        ink, _ = layout.get_pixel_extents()
+        # render the text (antialiased) onto a transparent surface of
+        # exactly that size
+        surface = cairo.ImageSurface(
+            cairo.FORMAT_ARGB32, max(ink.width, 1), max(ink.height, 1)
+            )
+        context = cairo.Context(surface)
+        layout = self._make_layout(context, markup)
+        context.move_to(-ink.x, -ink.y)
+        PangoCairo.show_layout(context, layout)
+        if return_bytes:
+            image_data = io.BytesIO()
+            surface.write_to_png(image_data)
+            return image_data.getvalue()
+        surface.write_to_png(filename)
 
 class MemriseImageAdder:
     """Class to sign in to Memrise using Chrome and render and upload
     images for the words in a given column of an open level in a course
     edit page."""
+    # script that returns the entries of the unfolded levels, per level,
+    # as lists of: ID, texts of the cells, whether it has an image, and
+    # whether it has an image input field
+    _js_find_entries = '''
+        return Array.from(document.querySelectorAll('div[class="level"]')).map(
+            level => Array.from(level.querySelectorAll('tr.thing')).map(tr => {
+                const image = tr.querySelector('td.cell.image button');
+                return [
+                    tr.getAttribute('data-thing-id'),
+                    Array.from(tr.querySelectorAll('td.cell')).map(td => {
+                        const text = td.querySelector('div.text');
+                        return text ? text.innerText : null;
+                        }),
+                    image !== null && !image.classList.contains('disabled'),
+                    tr.querySelector("td[class~='image'] input") !== null
+                    ];
+                })
+            );
+        '''
     #
     def __init__(self):
         """Constructor."""
@@ -201,6 +333,8 @@ class MemriseImageAdder:
         """Instantiate a text to PNG renderer."""
         if engine.lower() == 'xelatex':
             return XelatexImageMagickPngTextRenderer(hebrew_rtl=True)
+        elif cairo is not None:
+            return CairoPangoPngTextRenderer()
         else:
             return ImageMagickPangoPngTextRenderer()
     #
@@ -220,63 +354,111 @@ class MemriseImageAdder:
         # instantiate renderer
         renderer = self._get_renderer(engine)
         debug('renderer: {}'.format(renderer))
-        # parse the currently opened page's HTML source
-        html = self._driver.page_source
-        soup = BeautifulSoup(html, 'lxml')
-        # find all the unfolded class levels and process them
-        i = 0
-        for level in soup.select('div[class="level"]'):
-            i += 1
-            debug('open lesson number {}'.format(i), indent=1)
-            # go through each table row (entry)
-            j = 0
-            for entry in level.find_all('tr', {'class': 'thing'}):
-                j += 1
-                # get the entry's ID
-                tr_id = entry.get('data-thing-id')
-                debug('entry number {} with id {}'.format(j, tr_id), indent=2)
-                # extract the word (first text column)
-                cells = entry.find_all('td', {'class': 'cell'})
-                debug('column count is {}'.format(len(cells)), indent=2)
-                if column < len(cells):
-                    word_cell = cells[column]
-                    word = word_cell.find('div', {'class': 'text'}).string
-                    # check if it has an image
-                    image = entry.select_one('td.cell.image button')
-                    has_image = 'disabled' not in image.get('class')
-                    debug('word = "{}"'.format(word.encode('utf-8')), indent=3)
-                    debug('has_image = "{}"'.format(has_image), indent=3)
-                    # generate and upload image if it doesn't have one
-                    if not (skip_existing_images and has_image):
-                        # find the input field in Chrome
-                        input_field = (
-                            self._driver.find_element_by_css_selector(
-                                ('tr[data-thing-id=\'{}\'] '
-                                'td[class~=\'image\'] input').format(tr_id)
+        # render the images in the background (the renderers spend their
+        # time in subprocesses, so threads suffice), while uploading them
+        # has to happen from this thread
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=os.cpu_count()
+                ) as executor:
+            # map each word to its rendering and each rendering to the
+            # entries to upload it to
+            renders = {}
+            uploads = {}
+            # find all the unfolded class levels in the currently opened
+            # page and process them (looking up all their entries in a
+            # single round-trip to the browser)
+            i = 0
+            for level in self._driver.execute_script(self._js_find_entries):
+                i += 1
+                debug('open lesson number {}'.format(i), indent=1)
+                # go through each table row (entry)
+                j = 0
+                for tr_id, cells, has_image, has_input in level:
+                    j += 1
+                    debug('entry number {} with id {}'.format(j, tr_id), indent=2)
+                    # skip entries that have no image column to upload to
+                    if not has_input:
+                        debug('no image input, skipping', indent=3)
+                        continue
+                    # extract the word (first text column)
+                    debug('column count is {}'.format(len(cells)), indent=2)
+                    if column < len(cells) and cells[column] is not None:
+                        word = cells[column]
+                        debug('word = "{}"'.format(word.encode('utf-8')), indent=3)
+                        debug('has_image = "{}"'.format(has_image), indent=3)
+                        # generate and upload image if it doesn't have one
+                        if not (skip_existing_images and has_image):
+                            # render the image (only once for each word)
+                            if word not in renders:
+                                renders[word] = executor.submit(
+                                    renderer.render_text,
+                                    None, word, font, return_bytes=True
+                                    )
+                            uploads.setdefault(renders[word], []).append(
+                                (tr_id, has_image)
                                 )
-                            )
-                        debug('input field = {}'.format(
-                            input_field.get_attribute('outerHTML')),
-                            indent=3
-                            )
-                        # render the image
-                        image_name = 'render{}.png'.format(tr_id)
+                debug('lesson {} done, found {} entries'.format(i, j), indent=1)
+            # upload the images as soon as they have been rendered
+            for render in concurrent.futures.as_completed(uploads):
+                try:
+                    image_data = render.result()
+                except:
+                    image_data = None
+                    debug('"Failed to generate image.', indent=3)
+                # if rendered successfully, upload the image
+                if image_data:
+                    for tr_id, has_image in uploads[render]:
                         try:
-                            renderer.render_text(image_name, word, font)
-                        except:
-                            debug('"Failed to generate image.', indent=3)
-                        # if rendered successfully, upload and delete image
-                        if os.path.isfile(image_name):
-                            debug('sending image to input', indent=3)
-                            input_field.send_keys(
-                                os.path.join(os.getcwd(), image_name)
-                                )
-                            time.sleep(1)
-                            debug('removing file "{}"'.format(image_name), indent=3)
-                            os.remove(image_name)
-            debug('lesson {} done, processed {} entries'.format(i, j), indent=1)
+                            self._upload_image(tr_id, has_image, image_data)
+                        except Exception as e:
+                            debug('Failed to upload image: {}'.format(e), indent=3)
         debug('Done, processed {} lessons'.format(i))
     #
+    def _upload_image(self, tr_id, has_image, image_data):
+        """Upload image data through the image input field of the entry
+        with the given ID (and whether it already has an image), from a
+        temporary file that is deleted afterwards.
+        """
+        debug('<MIA._upload_image>(tr_id={})'.format(tr_id), indent=2)
+        with tempfile.NamedTemporaryFile(
+                dir=_UPLOAD_DIR,
+                prefix='render{}-'.format(tr_id),
+                suffix='.png',
+                delete=False
+                ) as image_file:
+            image_file.write(image_data)
+        try:
+            # look up the input field only now, as the rows may have been
+            # re-rendered by previous uploads
+            input_field = self._driver.find_element(
+                By.CSS_SELECTOR,
+                'tr[data-thing-id=\'{}\'] td[class~=\'image\'] input'.format(tr_id)
+                )
+            debug('sending image to input', indent=3)
+            input_field.send_keys(image_file.name)
+            if has_image:
+                # the upload can't be recognized, so give it some time
+                time.sleep(1)
+            else:
+                # the upload is done once the image button is enabled
+                button_selector = (
+                    'tr[data-thing-id=\'{}\'] td.cell.image button'.format(tr_id)
+                    )
+                try:
+                    WebDriverWait(
+                        self._driver, 10, poll_frequency=0.1,
+                        ignored_exceptions=[StaleElementReferenceException]
+                        ).until(
+                        lambda driver: 'disabled' not in driver.find_element(
+                            By.CSS_SELECTOR, button_selector
+                            ).get_attribute('class').split()
+                        )
+                except TimeoutException:
+                    debug('upload not confirmed within 10 seconds', indent=3)
+        finally:
+            debug('removing file "{}"'.format(image_file.name), indent=3)
+            os.remove(image_file.name)
+    #
     def start_chrome(self):
         """Start a Chrome session."""
         debug('<MIA.start_chrome>')
@@ -489,8 +671,20 @@ class GUI:
 
 def main():
     """Main method."""
-    with MemriseImageAdder() as mia:
-        GUI(mia)
+    # let ImageMagick keep its temporary files in memory (if possible, and if
+    # there is enough room for them)
+    dir_tmp = _TMPFS_DIR
+    if dir_tmp and shutil.disk_usage(dir_tmp).free < _TMPFS_MIN_FREE_SPACE:
+        dir_tmp = None
+    with tempfile.TemporaryDirectory(prefix='magick-', dir=dir_tmp) as dir_magick:
+        magick_tmpdir = os.environ.setdefault('MAGICK_TMPDIR', dir_magick)
+        try:
+            with MemriseImageAdder() as mia:
+                GUI(mia)
+        finally:
+            # restore the environment
+            if magick_tmpdir == dir_magick:
+                del os.environ['MAGICK_TMPDIR']
 
 if __name__ == '__main__':
 	main()